@@ -1,18 +1,36 @@
-import io
+import hashlib
+import json
 import logging
+import os
+import re
+import shutil
 import sys
-from pathlib import Path
-from zipfile import ZipFile
+import tempfile
+import zlib
+from collections import deque
+from pathlib import Path, PurePosixPath
+from typing import Optional
+from zipfile import BadZipFile, ZipFile
 
 import esptool
-import gevent.lock
+import gevent
 import gevent.subprocess
 import requests
 from eventmanager import Evt
+from requests.adapters import HTTPAdapter
 from RHUI import UIField, UIFieldSelectOption, UIFieldType
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
-_lock = gevent.lock.BoundedSemaphore()
+_CHUNK_SIZE = 1 << 20
+_DEFAULT_BAUD = "921600"
+_FIRMWARE_FILES = ("bootloader.bin", "elrs-netpack.bin", "partition-table.bin")
+_PROGRESS = re.compile(r"\((\d+) ?%\)")
+_ASSET_HOSTS = (
+    "https://github.com/",
+    "https://objects.githubusercontent.com/",
+    "https://release-assets.githubusercontent.com/",
+)
 
 
 class NetpackInstaller:
@@ -22,28 +40,158 @@ class NetpackInstaller:
         self._firmware_folder = Path(rhapi.server.data_dir).joinpath(
             "plugins/netpack_installer/firmware"
         )
-        self._downloaded = False
+        self._cache = self._firmware_folder.parent.joinpath("releases.json")
+        self._etag_path = self._firmware_folder.parent.joinpath("releases.etag")
+        self._fingerprint_path = self._firmware_folder.joinpath(".fingerprint")
+        self._downloaded_url = None
+        self._flashing = False
+        self._downloading = False
+        self._flash_argv = []
+        self._last_ports = None
         self.session = requests.Session()
-
-        ver_green = gevent.spawn(
-            self._get_download_versions,
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=["GET"],
+            ),
         )
-        gevent.wait((ver_green,))
-        self._versions = ver_green.value
+        for prefix in _ASSET_HOSTS:
+            self.session.mount(prefix, adapter)
+
+        self._versions = self._get_download_versions()
+        self._opts_stable = self._build_version_options(False)
+        self._opts_all = self._build_version_options(True)
+        self._last_beta_flag = None
 
         self.update_version_list()
+        self._prefetch = gevent.spawn(self._try_prefetch)
 
     def _get_download_versions(self) -> list:
 
+        headers = {"Accept": "application/vnd.github+json"}
+        if token := os.environ.get("GITHUB_TOKEN"):
+            headers["Authorization"] = f"Bearer {token}"
+
+        if self._cache.exists():
+            try:
+                headers["If-None-Match"] = self._etag_path.read_text().strip()
+            except OSError:
+                pass
+
         try:
             data = self.session.get(
                 "https://api.github.com/repos/i-am-grub/elrs-netpack/releases",
+                headers=headers,
                 timeout=5,
             )
         except Exception:
+            return self._read_cached_versions()
+
+        if data.status_code == 304 or not data.ok:
+            return self._read_cached_versions()
+
+        versions = data.json()
+
+        try:
+            self._cache.parent.mkdir(parents=True, exist_ok=True)
+            self._cache.write_text(data.text)
+            if etag := data.headers.get("ETag"):
+                self._etag_path.write_text(etag)
+            else:
+                self._etag_path.unlink(missing_ok=True)
+        except OSError:
+            logger.warning("Unable to cache netpack release list")
+
+        return versions
+
+    def _read_cached_versions(self) -> list:
+
+        try:
+            return json.loads(self._cache.read_text())
+        except (OSError, ValueError):
             return []
 
-        return data.json()
+    def _extract_members(self, zip_: ZipFile) -> Optional[dict]:
+        self._firmware_folder.mkdir(parents=True, exist_ok=True)
+
+        members = {}
+        for info in zip_.infolist():
+            name = PurePosixPath(info.filename).name
+            if not info.is_dir() and name in _FIRMWARE_FILES:
+                members[name] = info
+
+        if missing := [name for name in _FIRMWARE_FILES if name not in members]:
+            message = "Firmware archive is missing"
+            self._rhapi.ui.message_notify(
+                f"{self._rhapi.language.__(message)} {', '.join(missing)}"
+            )
+            return None
+
+        def extract() -> None:
+            for name, info in members.items():
+                dest = self._firmware_folder.joinpath(name)
+                with zip_.open(info) as src, open(
+                    dest, "wb", buffering=_CHUNK_SIZE
+                ) as dst:
+                    shutil.copyfileobj(src, dst, length=_CHUNK_SIZE)
+
+        gevent.get_hub().threadpool.apply(extract)
+
+        return {name: [info.file_size, info.CRC] for name, info in members.items()}
+
+    def _read_fingerprint(self) -> dict:
+
+        try:
+            return json.loads(self._fingerprint_path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _firmware_matches(self, files: dict) -> bool:
+        if set(files) != set(_FIRMWARE_FILES):
+            return False
+
+        for name in _FIRMWARE_FILES:
+            path = self._firmware_folder.joinpath(name)
+            try:
+                size, crc = files[name]
+                if path.stat().st_size != size or zlib.crc32(path.read_bytes()) != crc:
+                    return False
+            except (OSError, TypeError, ValueError):
+                return False
+
+        return True
+
+    def _mark_downloaded(self, url: str) -> None:
+        boot, firm, part = (
+            str(self._firmware_folder.joinpath(name).resolve())
+            for name in _FIRMWARE_FILES
+        )
+        self._flash_argv = [
+            "--before",
+            "default_reset",
+            "--after",
+            "hard_reset",
+            "--chip",
+            "esp32s3",
+            "write_flash",
+            "--flash_mode",
+            "dio",
+            "--flash_freq",
+            "80m",
+            "--flash_size",
+            "2MB",
+            "0x0",
+            boot,
+            "0x10000",
+            firm,
+            "0x8000",
+            part,
+        ]
+        self._downloaded_url = url
 
     def _download_firmware(self) -> None:
 
@@ -53,124 +201,196 @@ class NetpackInstaller:
             self._rhapi.ui.message_notify(self._rhapi.language.__(message))
             return
 
+        fingerprint = self._read_fingerprint()
+        files = fingerprint.get("files", {})
+        if fingerprint.get("url") == url and self._firmware_matches(files):
+            self._mark_downloaded(url)
+            return
+
         message = "Downloading firmware"
         self._rhapi.ui.message_notify(self._rhapi.language.__(message))
 
-        data_green = gevent.spawn(self.session.get, url)
-        gevent.wait((data_green,))
+        try:
+            with self.session.get(url, stream=True, timeout=30) as response:
+                response.raise_for_status()
+
+                with tempfile.SpooledTemporaryFile(
+                    max_size=8 * 1024 * 1024, buffering=_CHUNK_SIZE
+                ) as file_:
+                    digest = hashlib.sha256()
+                    for chunk in response.iter_content(_CHUNK_SIZE):
+                        digest.update(chunk)
+                        file_.write(chunk)
+
+                    sha256 = digest.hexdigest()
+                    unchanged = fingerprint.get("sha256") == sha256
+                    if not unchanged or not self._firmware_matches(files):
+                        self._fingerprint_path.unlink(missing_ok=True)
+                        file_.seek(0)
+                        with ZipFile(file_) as zip_:
+                            files = self._extract_members(zip_)
+        except (requests.RequestException, BadZipFile):
+            logger.exception("Failed to download netpack firmware")
+            message = "Firmware download failed"
+            self._rhapi.ui.message_notify(self._rhapi.language.__(message))
+            return
+
+        if files is None:
+            return
+
+        self._fingerprint_path.write_text(
+            json.dumps({"url": url, "sha256": sha256, "files": files})
+        )
+        self._mark_downloaded(url)
+
+    def _download_selected(self) -> bool:
+        while True:
+            url = self._rhapi.db.option("_netpack_version")
+            if url is not None and url == self._downloaded_url:
+                return True
 
-        with ZipFile(io.BytesIO(data_green.value.content)) as zip_:
-            zip_.extractall(self._firmware_folder)
+            self._download_firmware()
+            if url is None or self._downloaded_url != url:
+                return False
+
+    def _try_prefetch(self) -> None:
+        if self._rhapi.db.option("_netpack_version") is None:
+            return
 
-        self._downloaded = True
+        if self._flashing or self._downloading:
+            return
+
+        self._downloading = True
+        try:
+            self._download_selected()
+        except Exception:
+            logger.exception("Failed to prefetch netpack firmware")
+        finally:
+            self._downloading = False
 
     def flash_firmware(self, *_) -> None:
-        if _lock.locked():
+        while self._downloading:
+            self._prefetch.join()
+
+        if self._flashing:
             message = "Flashing already in progress"
             self._rhapi.ui.message_notify(self._rhapi.language.__(message))
             return
 
-        with _lock:
-
-            if not self._downloaded:
-                self._download_firmware()
+        self._flashing = True
+        try:
+            if not self._download_selected():
+                return
 
             if not (port := self._rhapi.db.option("_netpack_ports")):
                 message = "Port not selected"
                 self._rhapi.ui.message_notify(self._rhapi.language.__(message))
                 return
 
-            boot = self._firmware_folder.joinpath("bootloader.bin")
-            firm = self._firmware_folder.joinpath("elrs-netpack.bin")
-            part = self._firmware_folder.joinpath("partition-table.bin")
-
             message = "Flashing firmware"
             self._rhapi.ui.message_notify(self._rhapi.language.__(message))
 
-            process = gevent.subprocess.run(
-                [
-                    sys.executable,
-                    "-m",
-                    "esptool",
-                    "-p",
-                    port,
-                    "-b",
-                    "460800",
-                    "--before",
-                    "default_reset",
-                    "--after",
-                    "hard_reset",
-                    "--chip",
-                    "esp32s3",
-                    "write_flash",
-                    "--flash_mode",
-                    "dio",
-                    "--flash_freq",
-                    "80m",
-                    "--flash_size",
-                    "2MB",
-                    "0x0",
-                    str(boot.absolute()),
-                    "0x10000",
-                    str(firm.absolute()),
-                    "0x8000",
-                    str(part.absolute()),
-                ],
-            )
-
-            try:
-                process.check_returncode()
-            except gevent.subprocess.CalledProcessError:
+            command = [
+                sys.executable,
+                "-u",
+                "-m",
+                "esptool",
+                "-p",
+                port,
+                "-b",
+                self._rhapi.db.option("_netpack_baud") or _DEFAULT_BAUD,
+                *self._flash_argv,
+            ]
+
+            with gevent.subprocess.Popen(
+                command,
+                stdout=gevent.subprocess.PIPE,
+                stderr=gevent.subprocess.STDOUT,
+                bufsize=1,
+                text=True,
+            ) as process:
+                output = deque(maxlen=20)
+                last_step = None
+                for line in process.stdout:
+                    if not (line := line.strip()):
+                        continue
+
+                    logger.info(line)
+                    output.append(line)
+
+                    if match := _PROGRESS.search(line):
+                        step = int(match.group(1)) // 10
+                        if step != last_step:
+                            last_step = step
+                            self._rhapi.ui.message_notify(line)
+
+            if process.returncode:
                 message = "Netpack flashing failed"
                 self._rhapi.ui.message_notify(self._rhapi.language.__(message))
-                logger.error(process.stdout)
+                logger.error(
+                    "esptool exited with code %d:\n%s",
+                    process.returncode,
+                    "\n".join(output),
+                )
             else:
                 message = "Netpack flashing completed"
                 self._rhapi.ui.message_notify(self._rhapi.language.__(message))
+        finally:
+            self._flashing = False
 
     def update_port_list(self, *_):
 
+        ports = tuple(esptool.get_port_list())
+        if ports == self._last_ports:
+            return
+
+        self._last_ports = ports
+
         _netpack_ports = UIField(
             "_netpack_ports",
             "Serial Port",
             desc="The serial port the netpack is connected to for flashing fimrware",
             field_type=UIFieldType.SELECT,
-            options=[
-                UIFieldSelectOption(value=port, label=port)
-                for port in esptool.get_port_list()
-            ],
+            options=[UIFieldSelectOption(value=port, label=port) for port in ports],
         )
         self._rhapi.fields.register_option(_netpack_ports, "netpack_panel")
         self._rhapi.ui.broadcast_ui("settings")
 
-    def update_version_list(self, args=None):
+    def _build_version_options(self, allow_beta: bool) -> list:
 
-        def generate_options():
-            allow_beta = self._rhapi.db.option("_netpack_beta", as_int=True)
-            for version in self._versions:
-                if version["draft"]:
-                    continue
+        options = []
+        for version in self._versions:
+            if version["draft"]:
+                continue
 
-                if not allow_beta and version["prerelease"]:
-                    continue
+            if not allow_beta and version["prerelease"]:
+                continue
+
+            options.append(
+                UIFieldSelectOption(
+                    value=version["assets"][0]["browser_download_url"],
+                    label=version["tag_name"],
+                )
+            )
 
-                yield version["tag_name"], version["assets"][0]["browser_download_url"]
+        return options
 
+    def update_version_list(self, args=None):
         if args is not None and args["option"] != "_netpack_beta":
             return
 
+        allow_beta = bool(self._rhapi.db.option("_netpack_beta", as_int=True))
+        if allow_beta == self._last_beta_flag:
+            return
+
+        self._last_beta_flag = allow_beta
+
         _netpack_version = UIField(
             "_netpack_version",
             "Firmware Version",
             desc="The netpack firmware version to install",
             field_type=UIFieldType.SELECT,
-            options=[
-                UIFieldSelectOption(
-                    value=url,
-                    label=tag,
-                )
-                for tag, url in generate_options()
-            ],
+            options=self._opts_all if allow_beta else self._opts_stable,
         )
         self._rhapi.fields.register_option(_netpack_version, "netpack_panel")
         self._rhapi.ui.broadcast_ui("settings")
@@ -179,7 +399,8 @@ class NetpackInstaller:
         if args is None or args["option"] != "_netpack_version":
             return
 
-        self._downloaded = False
+        if self._prefetch.ready():
+            self._prefetch = gevent.spawn(self._try_prefetch)
 
 
 def initialize(rhapi):
@@ -196,6 +417,19 @@ def initialize(rhapi):
     )
     rhapi.fields.register_option(_netpack_beta, "netpack_panel")
 
+    _netpack_baud = UIField(
+        "_netpack_baud",
+        "Flash Baud Rate",
+        desc="Lower the baud rate if flashing fails on your device",
+        field_type=UIFieldType.SELECT,
+        value=_DEFAULT_BAUD,
+        options=[
+            UIFieldSelectOption(value=baud, label=baud)
+            for baud in (_DEFAULT_BAUD, "460800", "115200")
+        ],
+    )
+    rhapi.fields.register_option(_netpack_baud, "netpack_panel")
+
     installer = NetpackInstaller(rhapi)
     installer.update_port_list()
 